@@ -1,13 +1,25 @@
 import sys
 import os
-import json
 import random
+import tempfile
 import asyncio
+from bisect import bisect
+from functools import lru_cache
 from urllib.parse import quote_plus
-from aiohttp import ClientSession, ServerDisconnectedError
-from lxml import etree  # type: ignore
+
+try:
+    from orjson import dumps as json_dumps
+    from orjson import loads as json_loads
+except ImportError:
+    import json
+
+    def json_dumps(__obj):
+        return json.dumps(__obj).encode("utf-8")
+
+    json_loads = json.loads
 
 import logging
+
 logging.basicConfig(
     format="%(asctime)s %(levelname)s %(name)s.%(filename)s[%(lineno)d] %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
@@ -20,7 +32,14 @@ VERSION = "2.3.9"
 FIXED_UA = "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/29.0.1547.62 Safari/537.36"
 CACHE_FILE = "$HOME/.cache/fakeua/fake_useragent.json"
 BROWSERS = ['chrome', 'edge', 'firefox', 'safari', 'opera']
-BROWSERS_CUM_WEIGHTS = [80, 86, 93, 97, 100]
+BROWSERS_CUM_WEIGHTS = (80, 86, 93, 97, 100)
+# Skip the id table, comments and processing instructions: parse() never uses them.
+HTML_PARSER_OPTIONS = {"collect_ids": False, "remove_comments": True, "remove_pis": True}
+
+
+def random_browser():
+    return BROWSERS[bisect(BROWSERS_CUM_WEIGHTS, random.randrange(BROWSERS_CUM_WEIGHTS[-1]))]
+
 
 def quit_on_error(file_path, error, op):
     logger.error(f'{op} <{file_path}> failed: {error.__class__.__name__}: {error}')
@@ -35,11 +54,32 @@ def call_on_error(error, url, attempt, op):
     return attempt
 
 
+def in_liste(element):
+    for tag in ("li", "ul"):
+        element = element.getparent()
+        if element is None or element.tag != tag:
+            return False
+    element = element.getparent()
+    return element is not None and element.get("id") == "liste"
+
+
+def collect_versions(parser, versions, browser_num):
+    for _, element in parser.read_events():
+        if element.text and in_liste(element):
+            versions.append(element.text)
+        element.clear()
+        if len(versions) == browser_num:
+            return True
+    return False
+
+
 async def parse(browser, session):
+    from aiohttp import ServerDisconnectedError
+    from lxml import etree  # type: ignore
     base_page = "http://useragentstring.com/pages/useragentstring.php?name={browser}"
     url = base_page.format(browser=quote_plus(browser))
     attempt = 0
-    result = None
+    resp = None
 
     while True:
         if attempt == 3:
@@ -56,15 +96,39 @@ async def parse(browser, session):
             logger.debug(f'FETCHING {url} failed: {error.__class__.__name__}: {error}')
             break
         else:
-            result = await resp.text()
             break
 
-    if result is None:
+    if resp is None:
         return (browser, None)
 
-    lxml_element = etree.HTML(result)
+    # Stream the body through a pull parser and stop as soon as enough
+    # versions are collected, instead of buffering and parsing the whole page.
     browser_num = 50
-    versions = lxml_element.xpath('//*[@id="liste"]/ul/li/a/text()')[:browser_num]
+    versions = []
+    # Keep the Content-Type charset that resp.text() used to decode with;
+    # otherwise libxml2 guesses from <meta> or falls back to Latin-1.
+    parser = etree.HTMLPullParser(events=("end",), tag="a", encoding=resp.charset, **HTML_PARSER_OPTIONS)
+    done = False
+    try:
+        async for chunk in resp.content.iter_chunked(8192):
+            parser.feed(chunk)
+            done = collect_versions(parser, versions, browser_num)
+            if done:
+                break
+        if not done:
+            parser.close()
+            collect_versions(parser, versions, browser_num)
+    except Exception as error:
+        logger.debug(f'READING {url} failed: {error.__class__.__name__}: {error}')
+        return (browser, None)
+    finally:
+        if done:
+            # Drop the connection rather than draining the rest of the page.
+            # This deliberately gives up keep-alive reuse of the connection.
+            resp.close()
+        else:
+            resp.release()
+
     if not versions:
         logger.debug("Nothing parsed out. Check if the website has changed.")
         return (browser, None)
@@ -73,7 +137,28 @@ async def parse(browser, session):
     return (browser, versions)
 
 
+def write_cache(cache_path, dumped, mode):
+    # Write a uniquely named sibling temp file and rename it over the cache, so
+    # that readers never see a partially written file and concurrent writers
+    # never share a temp file.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), prefix=os.path.basename(cache_path) + ".", suffix=".tmp")
+    try:
+        try:
+            view = memoryview(dumped)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 async def dump(cache_path):
+    from aiohttp import ClientSession
     async with ClientSession() as session:
         tasks = []
         for browser in BROWSERS:
@@ -91,7 +176,7 @@ async def dump(cache_path):
             sys.exit(1)
         all_browsers[result[0]] = result[1]
 
-    dumped = json.dumps(all_browsers)
+    dumped = json_dumps(all_browsers)
 
     cache_path = os.path.expanduser(os.path.expandvars(cache_path))
     dir_name = os.path.dirname(cache_path)
@@ -102,11 +187,15 @@ async def dump(cache_path):
         except Exception as error:
             quit_on_error(cache_path, error, "CREATING DIRECTORY")
 
+    # mkstemp() creates the file as 0o600; give it the mode open() would have
+    # used. os.umask() can only be read by setting it, so restore it at once.
+    umask = os.umask(0)
+    os.umask(umask)
+    loop = asyncio.get_running_loop()
     try:
-        with open(cache_path, encoding="utf-8", mode="wt") as f:
-            f.write(dumped)
+        await loop.run_in_executor(None, write_cache, cache_path, dumped, 0o666 & ~umask)
     except Exception as error:
-            quit_on_error(cache_path, error, "WRITING")
+        quit_on_error(cache_path, error, "WRITING")
     logger.debug(f"Data has been stored in <{cache_path}>\n")
 
 
@@ -126,40 +215,54 @@ def remove(cache_path):
     logger.debug(f"<{cache_path}> has been removed successfully.\n")
 
 
-async def read_and_random(browser, cache_path):
-    cache_path = os.path.expanduser(os.path.expandvars(cache_path))
-    if not os.path.isfile(cache_path):
-        logger.debug(f"<{cache_path}> not found. LOADING cache...")
-        await dump(cache_path)
+@lru_cache(maxsize=4)
+def load_cache(cache_path, mtime):
+    # `mtime` is only part of the cache key: a rewritten file gets a fresh entry.
+    with open(cache_path, mode="rb") as f:
+        return json_loads(f.read())
 
-    try:
-        with open(cache_path, encoding="utf-8") as f:
-            data = f.read()
 
+def random_from_cache(browser, cache_path):
+    try:
+        data = load_cache(cache_path, os.stat(cache_path).st_mtime_ns)
     except Exception as error:
         logger.debug(f'Opening <{cache_path}> failed: {error.__class__.__name__}: {error}')
         logger.debug("Resort to a fixed useragent.")
         return FIXED_UA
     else:
         logger.debug(f"Read <{cache_path}> successfully.")
-        ua = random.choice(json.loads(data)[browser])
+        ua = random.choice(data[browser])
         logger.debug(f'Randomized a useragent from <{cache_path}>')
         return ua
 
 
-async def main(browser=None, use_cache=True, cache_path=CACHE_FILE):
+async def read_and_random(browser, cache_path):
+    cache_path = os.path.expanduser(os.path.expandvars(cache_path))
+    if not os.path.isfile(cache_path):
+        logger.debug(f"<{cache_path}> not found. LOADING cache...")
+        await dump(cache_path)
+    return random_from_cache(browser, cache_path)
+
+
+def choose_browser(browser):
     if browser is None:
         logger.debug("A browser will be randomly given.")
-        browser = random.choices(BROWSERS, weights=BROWSERS_CUM_WEIGHTS, k=1)[0]
+        browser = random_browser()
         logger.debug(f'Got "{browser}".')
     else:
         logger.debug(f'You gave "{browser}".')
         browser = browser.strip().lower()
         if browser not in BROWSERS:
-            new_browser = random.choices(BROWSERS, weights=BROWSERS_CUM_WEIGHTS, k=1)[0]
+            new_browser = random_browser()
             logger.debug(f'"{browser}" not supported, should be one of {BROWSERS}. Randomized "{new_browser}"')
+            browser = new_browser
+    return browser
 
+
+async def main(browser=None, use_cache=True, cache_path=CACHE_FILE):
+    browser = choose_browser(browser)
     if not use_cache:
+        from aiohttp import ClientSession
         async with ClientSession() as session:
             (browser, versions) = await parse(browser, session)
             if versions is None:
@@ -186,6 +289,10 @@ async def aio_user_agent(browser=None, use_cache=True, cache_path=CACHE_FILE):
 
 
 def user_agent(browser=None, use_cache=True, cache_path=CACHE_FILE):
+    # An existing cache needs nothing awaited, so skip creating an event loop.
+    expanded_path = os.path.expanduser(os.path.expandvars(cache_path))
+    if use_cache and os.path.isfile(expanded_path):
+        return random_from_cache(choose_browser(browser), expanded_path)
     return asyncio.run(main(browser, use_cache, cache_path))
 
 
@@ -223,7 +330,7 @@ def run_on_term():
                 cache_path = CACHE_FILE
         else:
             cache_path = CACHE_FILE
-        result = asyncio.run(main(browser, use_cache, cache_path))
+        result = user_agent(browser, use_cache, cache_path)
         print(result)
 
     except KeyboardInterrupt: